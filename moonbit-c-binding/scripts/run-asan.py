@@ -16,47 +16,168 @@ On macOS, MOON_CC/MOON_AR env vars are set to use Homebrew LLVM (Apple Clang
 lacks LeakSanitizer). On other platforms the system compiler is used directly.
 
 Both `moon.pkg` (DSL format) and `moon.pkg.json` (JSON format) are supported.
+Files that already carry the ASan flags are not rewritten, so their mtimes
+(and moon's build cache) are preserved; `--force` rewrites them anyway.
+
+macOS toolchain detection results and the dummy object are cached under
+`${XDG_CACHE_HOME:-~/.cache}/moonbit-asan/`. The script needs only the
+standard library; if `orjson` is installed it is used to parse and emit
+`moon.pkg.json`.
 """
 
 import argparse
+import hashlib
 import json
 import os
-import platform
 import re
 import shutil
+import signal
+import stat
 import subprocess
 import sys
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from itertools import repeat
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable, Iterable, Iterator, TextIO, TypeVar
+
+try:
+    # Optional: much faster JSON parsing/serialization for large package files.
+    import orjson
+except ImportError:
+    orjson = None
+
 
+# Host OS, without importing platform. The supported hosts get their
+# platform.system() names; others keep the raw sys.platform value (e.g.
+# "freebsd14"), which only ever reaches the "Unsupported platform" error.
+_SYSTEM = {"darwin": "Darwin", "linux": "Linux", "win32": "Windows"}.get(
+    sys.platform, sys.platform
+)
 
 ASAN_COMPILE_FLAGS = "-g -fsanitize=address -fno-omit-frame-pointer"
+# Embedded in the dummy libmoonbitrun.o so an already-swapped object is recognized.
+DUMMY_MARKER = b"MOONBIT_ASAN_DUMMY"
+# Upper bound on threads used to patch/restore package files concurrently.
+MAX_IO_WORKERS = 8
+
+T = TypeVar("T")
+
+
+# Homebrew LLVM formulae to look for, in order of preference.
+LLVM_FORMULAE = ("llvm", "llvm@18", "llvm@19", "llvm@15", "llvm@13")
+# Default Homebrew prefixes on Apple Silicon and Intel Macs.
+BREW_PREFIXES = ("/opt/homebrew", "/usr/local")
+
+
+def _version_key(path: Path) -> tuple[int, ...]:
+    return tuple(int(part) for part in re.findall(r"\d+", path.name))
+
+
+def _brew_llvm_prefixes(brew: str) -> Iterator[str]:
+    """Yield candidate LLVM install prefixes, in LLVM_FORMULAE order."""
+    # One call for all formulae; brew fails the whole call if any formula
+    # is unknown.
+    try:
+        output = subprocess.run(
+            [brew, "--prefix", *LLVM_FORMULAE],
+            check=True, text=True, capture_output=True,
+        ).stdout
+        prefixes = output.split()
+        if len(prefixes) == len(LLVM_FORMULAE):
+            yield from prefixes
+            return
+    except subprocess.CalledProcessError:
+        pass
+    # Otherwise list the installed kegs under the Cellar, newest first.
+    try:
+        cellar = subprocess.run(
+            [brew, "--cellar"], check=True, text=True, capture_output=True
+        ).stdout.strip()
+    except subprocess.CalledProcessError:
+        cellar = ""
+    if cellar:
+        for llvm in LLVM_FORMULAE:
+            try:
+                kegs = sorted(Path(cellar, llvm).iterdir(), key=_version_key, reverse=True)
+            except OSError:
+                continue
+            yield from map(str, kegs)
+        return
+    # Last resort: ask for one formula at a time.
+    for llvm in LLVM_FORMULAE:
+        try:
+            yield subprocess.run(
+                [brew, "--prefix", llvm], check=True, text=True, capture_output=True
+            ).stdout.strip()
+        except subprocess.CalledProcessError:
+            continue
+
+
+def _llvm_clang_candidates() -> Iterator[Path]:
+    """Likely LLVM clang locations that can be checked without running brew."""
+    for llvm in LLVM_FORMULAE:
+        for brew_prefix in BREW_PREFIXES:
+            yield Path(brew_prefix) / "opt" / llvm / "bin" / "clang"
+    for path_dir in os.environ.get("PATH", "").split(os.pathsep):
+        if "llvm" in path_dir.lower():
+            yield Path(path_dir) / "clang"
 
 
 def _find_brew_clang() -> str | None:
     """Find Homebrew LLVM clang, which supports both ASan and LSan."""
+    # Fast path: stat the standard locations; brew is only asked as a last
+    # resort since each invocation is a slow subprocess.
+    for clang_path in _llvm_clang_candidates():
+        if clang_path.is_file():
+            return str(clang_path)
+
     brew = shutil.which("brew")
     if not brew:
         if Path("/opt/homebrew/bin/brew").exists():
             brew = "/opt/homebrew/bin/brew"
         else:
             return None
-    llvm_opts = ["llvm", "llvm@18", "llvm@19", "llvm@15", "llvm@13"]
-    for llvm in llvm_opts:
-        try:
-            llvm_prefix = subprocess.run(
-                [brew, "--prefix", llvm], check=True, text=True, capture_output=True
-            ).stdout.strip()
-        except subprocess.CalledProcessError:
-            continue
+    for llvm_prefix in _brew_llvm_prefixes(brew):
         clang_path = Path(llvm_prefix) / "bin" / "clang"
         if clang_path.exists():
             return str(clang_path)
     return None
 
 
-def macos_flags() -> tuple[str, dict[str, str]]:
+def _cc_supports_asan(cc: str, refresh: bool = False) -> bool:
+    """Check whether cc can build with -fsanitize=address.
+
+    A successful probe is remembered with a marker file keyed by the
+    compiler path, mtime and size, so later runs skip the test compile.
+    """
+    cc_stamp = _file_stamp(cc)
+    marker = None
+    if cc_stamp is not None:
+        key = hashlib.blake2b(f"{cc}:{cc_stamp}".encode(), digest_size=8).hexdigest()
+        marker = _cache_dir() / f"cc-asan-{key}.ok"
+        if not refresh and marker.is_file():
+            return True
+    result = subprocess.run(
+        [cc, "-fsanitize=address", "-x", "c", "-", "-o", "/dev/null"],
+        input="int main(){return 0;}",
+        text=True,
+        capture_output=True,
+    )
+    if result.returncode != 0:
+        return False
+    if marker is not None:
+        try:
+            marker.parent.mkdir(parents=True, exist_ok=True)
+            marker.touch()
+        except OSError:
+            pass
+    return True
+
+
+def macos_flags(refresh: bool = False) -> tuple[str, dict[str, str]]:
     """Try Homebrew LLVM first (supports LSan), fall back to system clang."""
     # Prefer Homebrew LLVM: supports both ASan and LSan (leak detection)
     brew_clang = _find_brew_clang()
@@ -65,13 +186,7 @@ def macos_flags() -> tuple[str, dict[str, str]]:
 
     # Fall back to system clang (Xcode 15+ supports ASan but NOT LSan)
     system_cc = shutil.which("cc") or "/usr/bin/cc"
-    result = subprocess.run(
-        [system_cc, "-fsanitize=address", "-x", "c", "-", "-o", "/dev/null"],
-        input="int main(){return 0;}",
-        text=True,
-        capture_output=True,
-    )
-    if result.returncode == 0:
+    if _cc_supports_asan(system_cc, refresh):
         return (system_cc, {"cc-flags": ASAN_COMPILE_FLAGS, "detect_leaks": "0"})
 
     raise Exception(
@@ -92,16 +207,124 @@ def windows_flags() -> tuple[str, dict[str, str]]:
     })
 
 
-def get_flags() -> tuple[str, dict[str, str]]:
-    """Return (cc_path, flags_dict). cc_path is used for mimalloc and macOS MOON_CC."""
-    system = platform.system()
-    if system == "Darwin":
-        return macos_flags()
-    elif system == "Linux":
+def _probe_flags(refresh: bool = False) -> tuple[str, dict[str, str]]:
+    if _SYSTEM == "Darwin":
+        return macos_flags(refresh)
+    elif _SYSTEM == "Linux":
         return linux_flags()
-    elif system == "Windows":
+    elif _SYSTEM == "Windows":
         return windows_flags()
-    raise Exception(f"Unsupported platform: {system}")
+    raise Exception(f"Unsupported platform: {_SYSTEM}")
+
+
+# ---------------------------------------------------------------------------
+# Toolchain cache
+# ---------------------------------------------------------------------------
+
+
+def _cache_dir() -> Path:
+    """Directory for cached toolchain probe results."""
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "moonbit-asan"
+
+
+def _host_release_machine() -> tuple[str, str]:
+    """Return the OS release and machine type, as platform.uname() would."""
+    if hasattr(os, "uname"):
+        uname = os.uname()
+        return uname.release, uname.machine
+    return "", os.environ.get("PROCESSOR_ARCHITECTURE", "")
+
+
+def _flags_cache_key() -> str:
+    release, _ = _host_release_machine()
+    # PATH decides which compilers the probe can find.
+    path = os.environ.get("PATH", "")
+    key = f"{_SYSTEM}:{release}:{sys.executable}:{path}"
+    return hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+
+
+def _file_stamp(path: str) -> str | None:
+    """Identify a file version by mtime and size; None if it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return f"{st.st_mtime_ns}:{st.st_size}"
+
+
+def _read_flags_cache(cache_file: Path) -> dict[str, Any]:
+    """Read the flags cache, treating a missing or corrupt file as empty."""
+    try:
+        cache = json.loads(cache_file.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _load_cached_flags(
+    cache: dict[str, Any], key: str
+) -> tuple[str, dict[str, str]] | None:
+    """Return cached (cc_path, flags) if the compiler is unchanged since caching."""
+    try:
+        entry = cache[key]
+        cc_path = entry["cc_path"]
+        cc_stamp = entry["cc_stamp"]
+        flags = entry["flags"]
+    except (KeyError, TypeError):
+        return None
+    if _file_stamp(cc_path) != cc_stamp:
+        return None
+    return (cc_path, flags)
+
+
+def _store_cached_flags(
+    cache_file: Path,
+    cache: dict[str, Any],
+    key: str,
+    cc_path: str,
+    flags: dict[str, str],
+) -> None:
+    """Record (cc_path, flags) under key in cache and write it to cache_file."""
+    cc_stamp = _file_stamp(cc_path)
+    if cc_stamp is None:
+        # Not a file path (e.g. "cl" on Windows); nothing to validate against.
+        return
+    cache[key] = {"cc_path": cc_path, "cc_stamp": cc_stamp, "flags": flags}
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write_text(cache_file, json.dumps(cache, indent=2) + "\n")
+    except OSError:
+        pass
+
+
+def get_flags(refresh: bool = False) -> tuple[str, dict[str, str]]:
+    """Return (cc_path, flags_dict). cc_path is used for mimalloc and macOS MOON_CC.
+
+    On macOS probing the toolchain can spawn several subprocesses, so the
+    result is cached on disk and reused while PATH and the compiler binary
+    are unchanged (same mtime and size). Pass refresh=True to probe again.
+    Elsewhere probing is a PATH lookup and is not cached.
+    """
+    if _SYSTEM != "Darwin":
+        return _probe_flags(refresh)
+    cache_file = _cache_dir() / "flags.json"
+    cache = _read_flags_cache(cache_file)
+    key = _flags_cache_key()
+    if not refresh:
+        cached = _load_cached_flags(cache, key)
+        # A cached Apple Clang fallback goes stale once Homebrew LLVM is
+        # installed; noticing that only takes a few stat calls.
+        stale = (
+            cached is not None
+            and cached[1].get("detect_leaks") == "0"
+            and any(path.is_file() for path in _llvm_clang_candidates())
+        )
+        if cached is not None and not stale:
+            return cached
+    cc_path, flags = _probe_flags(refresh)
+    _store_cached_flags(cache_file, cache, key, cc_path, flags)
+    return (cc_path, flags)
 
 
 # ---------------------------------------------------------------------------
@@ -126,14 +349,75 @@ def _find_libmoonbitrun() -> Path | None:
     return None
 
 
-def disable_mimalloc(cc_path: str) -> tuple[Path, bytes] | None:
+_DUMMY_SOURCE = (
+    f'const char moonbit_asan_dummy_marker[] = "{DUMMY_MARKER.decode()}";\n'
+)
+
+
+def _compile_dummy_object(cc_path: str, out_path: Path) -> None:
+    """Compile an otherwise empty C file carrying DUMMY_MARKER to out_path."""
+    if _SYSTEM != "Windows":
+        # Feed the source on stdin; no temporary file needed.
+        subprocess.run(
+            [cc_path, "-x", "c", "-c", "-", "-o", str(out_path)],
+            input=_DUMMY_SOURCE,
+            text=True,
+            check=True,
+            capture_output=True,
+        )
+        return
+
+    # cl.exe cannot read source from stdin.
+    with tempfile.NamedTemporaryFile("w", suffix=".c", delete=False) as dummy_file:
+        dummy_file.write(_DUMMY_SOURCE)
+    try:
+        subprocess.run(
+            ["cl.exe", dummy_file.name, "/c", f"/Fo:{out_path}"],
+            check=True,
+            capture_output=True,
+        )
+    finally:
+        os.unlink(dummy_file.name)
+
+
+def _cached_dummy_object(cc_path: str) -> Path | None:
+    """Return a cached dummy object for this compiler, compiling it if needed.
+
+    The object only depends on the platform and the compiler, so it is built
+    once and reused by later runs. Returns None if it cannot be cached.
+    """
+    cc_stamp = _file_stamp(shutil.which(cc_path) or cc_path)
+    if cc_stamp is None:
+        return None
+    _, machine = _host_release_machine()
+    key = f"{_SYSTEM}:{machine}:{cc_path}:{cc_stamp}"
+    digest = hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+    cached = _cache_dir() / f"dummy-{digest}.o"
+    if cached.is_file():
+        return cached
+    tmp = cached.with_name(f"{cached.name}.{os.getpid()}.tmp")
+    try:
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        _compile_dummy_object(cc_path, tmp)
+        os.replace(tmp, cached)
+    except OSError:
+        return None
+    finally:
+        # Also covers a failed compile (CalledProcessError), which is left to
+        # propagate as it would without the cache.
+        tmp.unlink(missing_ok=True)
+    return cached
+
+
+def disable_mimalloc(cc_path: str, force: bool = False) -> tuple[Path, bytes] | None:
     """Replace libmoonbitrun.o with a dummy empty object to disable mimalloc.
 
     MoonBit bundles mimalloc as its allocator via libmoonbitrun.o. mimalloc
     intercepts malloc/free, which prevents ASan from tracking allocations.
     Replacing it with an empty object lets ASan's allocator take over.
 
-    Returns (path, original_bytes) for restoration, or None if not found.
+    Returns (path, original_bytes) for restoration, or None if not found or
+    if the dummy object is already in place (unless force is set).
     """
     moonbitrun = _find_libmoonbitrun()
     if moonbitrun is None:
@@ -141,25 +425,15 @@ def disable_mimalloc(cc_path: str) -> tuple[Path, bytes] | None:
         return None
 
     original = moonbitrun.read_bytes()
+    if DUMMY_MARKER in original and not force:
+        print(f"mimalloc already disabled: {moonbitrun}")
+        return None
 
-    # Compile an empty C file as the replacement
-    fd, dummy_c = tempfile.mkstemp(suffix=".c")
-    os.close(fd)
-    try:
-        if platform.system() == "Windows":
-            subprocess.run(
-                ["cl.exe", dummy_c, "/c", f"/Fo:{moonbitrun}"],
-                check=True,
-                capture_output=True,
-            )
-        else:
-            subprocess.run(
-                [cc_path, "-c", dummy_c, "-o", str(moonbitrun)],
-                check=True,
-                capture_output=True,
-            )
-    finally:
-        os.unlink(dummy_c)
+    cached = _cached_dummy_object(cc_path)
+    if cached is not None:
+        shutil.copyfile(cached, moonbitrun)
+    else:
+        _compile_dummy_object(cc_path, moonbitrun)
 
     print(f"Disabled mimalloc: {moonbitrun}")
     return (moonbitrun, original)
@@ -177,6 +451,55 @@ def display_path(path: Path, repo_root: Path) -> str:
         return str(path)
 
 
+def _read_text(path: Path) -> str:
+    """Read a UTF-8 text file like Path.read_text, without the io wrappers.
+
+    The file is sized with fstat and normally read with a single os.read.
+    Newlines are translated the same way read_text does.
+    """
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        size = os.fstat(fd).st_size
+        # Ask for one byte more than the size: getting at most size bytes
+        # means EOF was reached; only a file that grew needs more reads.
+        data = os.read(fd, size + 1)
+        if len(data) > size:
+            chunks = [data]
+            while chunks[-1]:
+                chunks.append(os.read(fd, 1 << 16))
+            data = b"".join(chunks)
+    finally:
+        os.close(fd)
+    text = data.decode("utf-8")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+def atomic_write(path: Path, write: Callable[[TextIO], object]) -> None:
+    """Fill a temp file in path's directory with write, then os.replace it.
+
+    Readers (such as a concurrently running moon) never observe a partially
+    written file. The existing file's permission bits are kept.
+    """
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as tmp_file:
+            write(tmp_file)
+        try:
+            os.chmod(tmp, stat.S_IMODE(path.stat().st_mode))
+        except FileNotFoundError:
+            pass
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def atomic_write_text(path: Path, text: str) -> None:
+    atomic_write(path, lambda fp: fp.write(text))
+
+
 def resolve_pkg_path(repo_root: Path, pkg_arg: str) -> Path:
     requested = Path(pkg_arg)
     requested = requested if requested.is_absolute() else (repo_root / requested)
@@ -205,6 +528,35 @@ def resolve_pkg_path(repo_root: Path, pkg_arg: str) -> Path:
 # ---------------------------------------------------------------------------
 
 
+@lru_cache(maxsize=None)
+def _native_flag_updates(
+    flag_items: tuple[tuple[str, str], ...], existing_stub_flags: str, is_entry: bool
+) -> tuple[tuple[str, str], ...]:
+    """Return the (key, value) updates that patch one link.native object.
+
+    Cached, since sibling packages usually share the same inputs.
+    """
+    flags = dict(flag_items)
+    updates = []
+
+    # cc-flags: set ASan compile flags for MoonBit-generated C (entry packages only)
+    if is_entry and "cc-flags" in flags:
+        updates.append(("cc-flags", flags["cc-flags"]))
+
+    # stub-cc-flags: append ASan flags to existing value (preserving -I, -D, etc.)
+    if "stub-cc-flags" in flags:
+        # Windows: override entirely
+        updates.append(("stub-cc-flags", flags["stub-cc-flags"]))
+    elif ASAN_COMPILE_FLAGS in existing_stub_flags:
+        # Already patched (e.g. left over from an interrupted run)
+        updates.append(("stub-cc-flags", existing_stub_flags))
+    elif existing_stub_flags:
+        updates.append(("stub-cc-flags", existing_stub_flags + " " + ASAN_COMPILE_FLAGS))
+    else:
+        updates.append(("stub-cc-flags", ASAN_COMPILE_FLAGS))
+    return tuple(updates)
+
+
 def patch_link_native_json(
     moon_pkg: dict[str, Any], flags: dict[str, str], pkg_path: Path,
     is_entry: bool,
@@ -226,37 +578,166 @@ def patch_link_native_json(
     elif not isinstance(native, dict):
         raise ValueError(f'Expected "link.native" object in {pkg_path}')
 
-    # cc-flags: set ASan compile flags for MoonBit-generated C (entry packages only)
-    if is_entry and "cc-flags" in flags:
-        native["cc-flags"] = flags["cc-flags"]
+    # A null stub-cc-flags counts as empty.
+    existing_stub_flags = native.get("stub-cc-flags") or ""
+    native.update(
+        _native_flag_updates(tuple(flags.items()), existing_stub_flags, is_entry)
+    )
+    link["native"] = native
 
-    # stub-cc-flags: append ASan flags to existing value (preserving -I, -D, etc.)
-    existing_stub_flags = native.get("stub-cc-flags", "")
-    if "stub-cc-flags" in flags:
-        # Windows: override entirely
-        native["stub-cc-flags"] = flags["stub-cc-flags"]
-    elif existing_stub_flags:
-        native["stub-cc-flags"] = existing_stub_flags + " " + ASAN_COMPILE_FLAGS
-    else:
-        native["stub-cc-flags"] = ASAN_COMPILE_FLAGS
 
-    link["native"] = native
+def _json_loads(text: str) -> Any:
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
 
 
-def patch_json_file(pkg_path: Path, flags: dict[str, str], is_entry: bool) -> str:
-    """Patch a moon.pkg.json file. Returns the patched text."""
-    text = pkg_path.read_text(encoding="utf-8")
+def write_json_pkg(moon_pkg: dict[str, Any], fp: TextIO) -> None:
+    """Write a package dict with 2-space indentation and a final newline."""
+    if orjson is not None:
+        fp.write(orjson.dumps(moon_pkg, option=orjson.OPT_INDENT_2).decode())
+    else:
+        # Streamed, so no full copy of the output is built in memory.
+        # ensure_ascii=False matches orjson, which emits UTF-8 as-is.
+        json.dump(moon_pkg, fp, indent=2, separators=(",", ": "), ensure_ascii=False)
+    fp.write("\n")
+
+
+def load_json_pkg(text: str, pkg_path: Path) -> dict[str, Any]:
+    """Parse moon.pkg.json text, exiting with a readable error on failure."""
     try:
-        moon_pkg = json.loads(text)
+        moon_pkg = _json_loads(text)
     except json.JSONDecodeError as error:
         sys.exit(f"Failed to parse JSON in {pkg_path}: {error}")
     if not isinstance(moon_pkg, dict):
         sys.exit(f"Package file is not a JSON object: {pkg_path}")
+    return moon_pkg
+
+
+# A JSON string literal or a structural character; everything else is skipped.
+_JSON_TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|[{}\[\]:,]')
+
+
+def _scan_json_object(
+    text: str, open_brace: int
+) -> tuple[dict[str, tuple[int, int, int]], int] | None:
+    """Locate the members of the JSON object whose "{" is at open_brace.
+
+    Returns ({key: (key_start, value_start, value_end)}, closing_brace), or
+    None if there is no object at open_brace, it is not closed, or a key
+    repeats (parsers keep the last duplicate, so editing by position is
+    ambiguous). Braces inside strings are ignored.
+    """
+    if not text.startswith("{", open_brace):
+        return None
+    members: dict[str, tuple[int, int, int]] = {}
+    depth = 0
+    key: str | None = None
+    key_start = value_start = -1
+    for tok in _JSON_TOKEN_RE.finditer(text, open_brace):
+        ch = tok.group()
+        if depth == 1:
+            if ch[0] == '"' and key is None:
+                key = json.loads(ch)
+                key_start = tok.start()
+                continue
+            if ch == ":":
+                value_start = tok.end()
+                while text[value_start].isspace():
+                    value_start += 1
+                continue
+            if ch in ",}" and key is not None:
+                value_end = value_start + len(text[value_start : tok.start()].rstrip())
+                if key in members:
+                    return None
+                members[key] = (key_start, value_start, value_end)
+                key = None
+        if ch in "{[":
+            depth += 1
+        elif ch in "}]":
+            depth -= 1
+            if depth == 0:
+                return (members, tok.start())
+    return None
+
+
+def _member_indent(text: str, key_start: int) -> str | None:
+    """Indentation of a member whose key starts its own line, else None."""
+    line_start = text.rfind("\n", 0, key_start) + 1
+    indent = text[line_start:key_start]
+    return indent if indent and indent.isspace() else None
+
+
+def _dumps_fragment(value: Any, unit: str, indent: str) -> str:
+    """Serialize value for splicing in at a member indented by indent."""
+    dumped = json.dumps(value, indent=unit, separators=(",", ": "), ensure_ascii=False)
+    return dumped.replace("\n", "\n" + indent)
+
+
+def _splice_link_native(text: str, link: dict[str, Any]) -> str | None:
+    """Splice the patched link (or just link.native) into the original text.
+
+    Only the changed value is re-serialized; the rest of the file keeps its
+    formatting and key order. Returns None when the layout is not the usual
+    one-member-per-line style, so the caller can re-serialize the whole file.
+    """
+    root_start = len(text) - len(text.lstrip())
+    root = _scan_json_object(text, root_start)
+    if root is None or not root[0]:
+        return None
+    members, root_close = root
+    unit = _member_indent(text, min(span[0] for span in members.values()))
+    if unit is None:
+        return None
+
+    if "link" not in members:
+        last = root_close - 1
+        while text[last].isspace():
+            last -= 1
+        fragment = f'"link": {_dumps_fragment(link, unit, unit)}'
+        return f"{text[: last + 1]},\n{unit}{fragment}{text[last + 1 :]}"
+
+    link_key, link_start, link_end = members["link"]
+    # When link is not a plain object in the text (null, or with repeated
+    # keys), its whole value is replaced below.
+    link_scan = _scan_json_object(text, link_start)
+    if link_scan is not None and "native" in link_scan[0]:
+        native_key, native_start, native_end = link_scan[0]["native"]
+        indent = _member_indent(text, native_key)
+        if indent is not None:
+            fragment = _dumps_fragment(link["native"], unit, indent)
+            return text[:native_start] + fragment + text[native_end:]
+    indent = _member_indent(text, link_key)
+    if indent is None:
+        return None
+    return text[:link_start] + _dumps_fragment(link, unit, indent) + text[link_end:]
+
+
+def patch_json_file(
+    text: str, pkg_path: Path, flags: dict[str, str], is_entry: bool,
+    moon_pkg: dict[str, Any],
+) -> str | None:
+    """Patch moon.pkg.json text. Returns the patched text.
+
+    moon_pkg is the parsed text and is patched in place. Only the link.native
+    value is rewritten in text when the file layout allows it; otherwise None
+    is returned and the whole of moon_pkg should be written with
+    write_json_pkg. Returns text itself when the ASan flags are already in
+    place.
+    """
+    # Only link.native is modified and its values are strings, so a shallow
+    # copy is enough to tell whether patching changed anything.
+    link = moon_pkg.get("link")
+    native = link.get("native") if isinstance(link, dict) else None
+    original_native = dict(native) if isinstance(native, dict) else None
     try:
         patch_link_native_json(moon_pkg, flags, pkg_path, is_entry)
     except ValueError as error:
         sys.exit(str(error))
-    return json.dumps(moon_pkg, indent=2) + "\n"
+    if moon_pkg["link"]["native"] == original_native:
+        return text
+    spliced = _splice_link_native(text, moon_pkg["link"])
+    return spliced
 
 
 # ---------------------------------------------------------------------------
@@ -264,31 +745,71 @@ def patch_json_file(pkg_path: Path, flags: dict[str, str], is_entry: bool) -> st
 # ---------------------------------------------------------------------------
 
 
+_OPTIONS_CALL_RE = re.compile(r"\boptions\s*\(")
+_ENTRY_INDENT_RE = re.compile(r"\n(\s+)\S")
+_IS_MAIN_DSL_RE = re.compile(r'(?:is-main|is_main|"is-main"|"is_main")\s*:\s*true\b')
+
+
+# `link: {` / `native: {` with a bare or quoted key.
+_LINK_BLOCK_RE = re.compile(r'(?:link|"link")\s*:\s*\{')
+_NATIVE_BLOCK_RE = re.compile(r'(?:native|"native")\s*:\s*\{')
+
+
+# `key: "value"` with a quoted (group 1) or bare (group 2) key; group 3 is the value.
+_STRING_ENTRY_RE = re.compile(
+    r'(?:"([^"]+)"|([A-Za-z_][\w-]*))\s*:\s*"((?:[^"\\]|\\.)*)"'
+)
+
+
+# A string literal or a block delimiter; delimiters inside strings are skipped.
+_BRACE_TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|[{}]')
+_PAREN_TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|[()]')
+
+
+def _find_block_end(
+    text: str, start: int, token_re: re.Pattern[str], limit: int | None = None
+) -> int | None:
+    """Return the position just past the delimiter closing an already-open block.
+
+    start is the position right after the opening delimiter; token_re is
+    _BRACE_TOKEN_RE or _PAREN_TOKEN_RE. The regex jumps straight between
+    delimiters and string literals, so delimiters inside strings are ignored.
+    Returns None if the block is not closed before limit.
+    """
+    if limit is None:
+        tokens = token_re.finditer(text, start)
+    else:
+        tokens = token_re.finditer(text, start, limit)
+    depth = 1
+    for tok in tokens:
+        ch = tok.group()
+        if ch in ("{", "("):
+            depth += 1
+        elif ch in ("}", ")"):
+            depth -= 1
+            if depth == 0:
+                return tok.end()
+    return None
+
+
 def _find_object_block(
     text: str,
-    key: str,
+    pattern: re.Pattern[str],
     search_start: int = 0,
     search_end: int | None = None,
 ) -> tuple[int, int] | None:
-    """Find the start and end positions of a key: { ... } object block."""
-    key_pattern = rf'(?:{re.escape(key)}|"{re.escape(key)}")'
-    haystack = text[search_start:search_end]
-    m = re.search(rf"{key_pattern}\s*:\s*\{{", haystack)
+    """Find the start and end positions of the { ... } block opened by pattern."""
+    if search_end is None:
+        m = pattern.search(text, search_start)
+    else:
+        m = pattern.search(text, search_start, search_end)
     if m is None:
         return None
-    start = search_start + m.end()
-    depth = 1
-    pos = start
-    limit = len(text) if search_end is None else search_end
-    while pos < limit and depth > 0:
-        if text[pos] == "{":
-            depth += 1
-        elif text[pos] == "}":
-            depth -= 1
-        pos += 1
-    if depth != 0:
+    start = m.end()
+    end = _find_block_end(text, start, _BRACE_TOKEN_RE, search_end)
+    if end is None:
         return None
-    return (start, pos)
+    return (start, end)
 
 
 def _find_root_block(text: str) -> tuple[int, int] | None:
@@ -296,36 +817,22 @@ def _find_root_block(text: str) -> tuple[int, int] | None:
     start = text.find("{")
     if start < 0:
         return None
-    depth = 1
-    pos = start + 1
-    while pos < len(text) and depth > 0:
-        if text[pos] == "{":
-            depth += 1
-        elif text[pos] == "}":
-            depth -= 1
-        pos += 1
-    if depth != 0:
+    end = _find_block_end(text, start + 1, _BRACE_TOKEN_RE)
+    if end is None:
         return None
-    return (start + 1, pos)
+    return (start + 1, end)
 
 
 def _find_options_block(text: str) -> tuple[int, int] | None:
     """Find the start and end positions of options( ... ) content."""
-    m = re.search(r"\boptions\s*\(", text)
+    m = _OPTIONS_CALL_RE.search(text)
     if m is None:
         return None
     start = m.end()
-    depth = 1
-    pos = start
-    while pos < len(text) and depth > 0:
-        if text[pos] == "(":
-            depth += 1
-        elif text[pos] == ")":
-            depth -= 1
-        pos += 1
-    if depth != 0:
+    end = _find_block_end(text, start, _PAREN_TOKEN_RE)
+    if end is None:
         return None
-    return (start, pos)
+    return (start, end)
 
 
 def _find_link_block(
@@ -334,12 +841,12 @@ def _find_link_block(
     search_end: int | None = None,
 ) -> tuple[int, int] | None:
     """Find the start and end positions of the link: { ... } block."""
-    return _find_object_block(text, "link", search_start, search_end)
+    return _find_object_block(text, _LINK_BLOCK_RE, search_start, search_end)
 
 
 def _find_native_block(text: str) -> tuple[int, int] | None:
     """Find the start and end positions of the native: { ... } block."""
-    return _find_object_block(text, "native")
+    return _find_object_block(text, _NATIVE_BLOCK_RE)
 
 
 def _closing_indent(text: str, closing_brace: int) -> str:
@@ -351,35 +858,34 @@ def _closing_indent(text: str, closing_brace: int) -> str:
 
 def _detect_entry_indent(text: str, content_start: int, content_end: int) -> str:
     """Detect indentation for key entries in a container."""
-    m = re.search(r"\n(\s+)\S", text[content_start : content_end - 1])
+    m = _ENTRY_INDENT_RE.search(text, content_start, content_end - 1)
     return m.group(1) if m else "      "
 
 
-def _insert_entry_in_container(
+def _container_insertion(
     text: str,
     content_start: int,
     container_end: int,
     entry: str,
     entry_indent: str,
-) -> str:
-    """Insert an entry into a comma-separated container preserving syntax."""
+) -> tuple[int, int, str]:
+    """Compute the edit inserting an entry into a comma-separated container.
+
+    Returns (start, end, replacement): text[start:end] becomes replacement.
+    """
     closing_brace = container_end - 1
     block_content = text[content_start:closing_brace]
-    has_entries = bool(block_content.strip())
+    trimmed = block_content.rstrip()
     multiline = "\n" in block_content
 
-    if not has_entries:
+    if not trimmed:
         if multiline:
             insertion = f"\n{entry_indent}{entry},\n{_closing_indent(text, closing_brace)}"
         else:
             insertion = f" {entry} "
-        return text[:content_start] + insertion + text[closing_brace:]
+        return (content_start, closing_brace, insertion)
 
-    last = closing_brace - 1
-    while last >= content_start and text[last].isspace():
-        last -= 1
-    if last < content_start:
-        return text
+    last = content_start + len(trimmed) - 1
 
     needs_comma = text[last] != ","
     if multiline:
@@ -391,25 +897,33 @@ def _insert_entry_in_container(
         tail_ws = text[last + 1 : closing_brace]
         separator = ", " if needs_comma else " "
         insertion = f"{separator}{entry}{tail_ws}"
-    return text[: last + 1] + insertion + text[closing_brace:]
+    return (last + 1, closing_brace, insertion)
 
 
-def _insert_entry_in_block(
+def _insert_native_entry(
     text: str,
     content_start: int,
-    block_end: int,
+    container_end: int,
     entry: str,
     entry_indent: str,
-) -> str:
-    """Insert an entry into a { ... } block while preserving valid syntax."""
-    return _insert_entry_in_container(text, content_start, block_end, entry, entry_indent)
+) -> tuple[str, tuple[int, int]]:
+    """Insert an entry containing an empty native block into a container.
 
+    Returns the new text and the bounds of the inserted native block, so it
+    need not be searched for again.
+    """
+    start, end, insertion = _container_insertion(
+        text, content_start, container_end, entry, entry_indent
+    )
+    native_start = start + insertion.index('"native": {') + len('"native": {')
+    return text[:start] + insertion + text[end:], (native_start, native_start + 1)
 
-def _ensure_native_block(text: str) -> str:
-    """Ensure link.native exists by creating missing blocks when needed."""
-    if _find_native_block(text) is not None:
-        return text
 
+def _insert_native_block(text: str) -> tuple[str, tuple[int, int]]:
+    """Create link.native, adding missing enclosing blocks when needed.
+
+    Returns the new text and the bounds of the empty native block.
+    """
     options_bounds = _find_options_block(text)
     if options_bounds is not None:
         options_start, options_end = options_bounds
@@ -417,12 +931,12 @@ def _ensure_native_block(text: str) -> str:
         if link_bounds is not None:
             content_start, block_end = link_bounds
             entry_indent = _detect_entry_indent(text, content_start, block_end)
-            return _insert_entry_in_block(
+            return _insert_native_entry(
                 text, content_start, block_end, '"native": {}', entry_indent
             )
 
         entry_indent = _detect_entry_indent(text, options_start, options_end)
-        return _insert_entry_in_container(
+        return _insert_native_entry(
             text,
             options_start,
             options_end,
@@ -434,7 +948,7 @@ def _ensure_native_block(text: str) -> str:
     if link_bounds is not None:
         content_start, block_end = link_bounds
         entry_indent = _detect_entry_indent(text, content_start, block_end)
-        return _insert_entry_in_block(
+        return _insert_native_entry(
             text, content_start, block_end, '"native": {}', entry_indent
         )
 
@@ -442,9 +956,9 @@ def _ensure_native_block(text: str) -> str:
     if root_bounds is None:
         raise ValueError("Could not locate root object block in moon.pkg")
     content_start, block_end = root_bounds
-    m = re.search(r"\n(\s+)\S", text[content_start : block_end - 1])
+    m = _ENTRY_INDENT_RE.search(text, content_start, block_end - 1)
     entry_indent = m.group(1) if m else "  "
-    return _insert_entry_in_block(
+    return _insert_native_entry(
         text,
         content_start,
         block_end,
@@ -453,73 +967,118 @@ def _ensure_native_block(text: str) -> str:
     )
 
 
-def _find_string_value_in_native(text: str, key: str) -> str | None:
-    """Find a string value for key inside native block."""
+def _ensure_native_block(text: str) -> tuple[str, tuple[int, int]]:
+    """Ensure link.native exists. Returns the text and the native block bounds."""
     bounds = _find_native_block(text)
     if bounds is None:
-        return None
-    content_start, block_end = bounds
-    native_text = text[content_start : block_end - 1]
-    pattern = re.compile(rf'(?:{re.escape(key)}|"{re.escape(key)}")\s*:\s*"([^"]*)"')
-    m = pattern.search(native_text)
-    return m.group(1) if m else None
+        return _insert_native_block(text)
+    return text, bounds
 
 
-def _replace_or_insert_in_native(text: str, key: str, value: str) -> str:
-    """Replace an existing key's value or insert a new key-value pair in native."""
-    bounds = _find_native_block(text)
-    if bounds is None:
-        raise ValueError('No "native" block found in moon.pkg')
-    content_start, block_end = bounds
-    native_text = text[content_start : block_end - 1]
-
-    # Replace existing key only inside native block.
-    pattern = re.compile(rf'((?:{re.escape(key)}|"{re.escape(key)}")\s*:\s*)"([^"]*)"')
-    if pattern.search(native_text):
-        replaced = pattern.sub(rf'\g<1>"{value}"', native_text, count=1)
-        return text[:content_start] + replaced + text[block_end - 1 :]
-
-    entry_indent = _detect_entry_indent(text, content_start, block_end)
-    return _insert_entry_in_block(
-        text,
-        content_start,
-        block_end,
-        f'"{key}": "{value}"',
-        entry_indent,
-    )
+def _native_string_entries(
+    text: str, content_start: int, block_end: int
+) -> dict[str, re.Match[str]]:
+    """Map each `key: "value"` entry in the native block to its match.
+
+    Scans the block once; the first occurrence of a key wins.
+    """
+    entries: dict[str, re.Match[str]] = {}
+    for m in _STRING_ENTRY_RE.finditer(text, content_start, block_end - 1):
+        entries.setdefault(m.group(1) or m.group(2), m)
+    return entries
+
+
+class DslEditor:
+    """Batch edits to the native block of moon.pkg text, applied in one pass.
+
+    Entries are located once up front; finalize() rebuilds the text with a
+    single join instead of copying the whole file once per edited key.
+    """
+
+    def __init__(self, text: str, content_start: int, block_end: int) -> None:
+        self.text = text
+        self.content_start = content_start
+        self.block_end = block_end
+        self.entries = _native_string_entries(text, content_start, block_end)
+        self.replacements: dict[str, str] = {}
+        self.insertions: dict[str, str] = {}
+
+    def get(self, key: str) -> str | None:
+        """Return the original string value of key, or None if absent."""
+        m = self.entries.get(key)
+        return m.group(3) if m else None
+
+    def replace_or_insert(self, key: str, value: str) -> None:
+        if key not in self.entries:
+            self.insertions[key] = value
+        elif self.entries[key].group(3) != value:
+            self.replacements[key] = value
+
+    def finalize(self) -> str:
+        """Return the edited text (the original object if nothing changed)."""
+        edits = [
+            (self.entries[key].start(3), self.entries[key].end(3), value)
+            for key, value in self.replacements.items()
+        ]
+        if self.insertions:
+            # Inserting all entries at once yields the same text as inserting
+            # them one by one.
+            text = self.text
+            entry_indent = _detect_entry_indent(text, self.content_start, self.block_end)
+            multiline = "\n" in text[self.content_start : self.block_end - 1]
+            separator = f",\n{entry_indent}" if multiline else ", "
+            entries = separator.join(
+                f'"{key}": "{value}"' for key, value in self.insertions.items()
+            )
+            edits.append(
+                _container_insertion(
+                    text, self.content_start, self.block_end, entries, entry_indent
+                )
+            )
+        if not edits:
+            return self.text
 
+        pieces = []
+        pos = 0
+        for start, end, replacement in sorted(edits):
+            pieces.append(self.text[pos:start])
+            pieces.append(replacement)
+            pos = end
+        pieces.append(self.text[pos:])
+        return "".join(pieces)
 
-def patch_dsl_file(pkg_path: Path, flags: dict[str, str], is_entry: bool) -> str:
-    """Patch a moon.pkg DSL file using text manipulation. Returns the patched text.
+
+def patch_dsl_file(
+    text: str, pkg_path: Path, flags: dict[str, str], is_entry: bool
+) -> str:
+    """Patch moon.pkg DSL text using text manipulation. Returns the patched text.
 
     Always patches stub-cc-flags. Only patches cc-flags when is_entry is True.
+    Returns text unchanged when the ASan flags are already in place.
     """
-    text = pkg_path.read_text(encoding="utf-8")
     try:
-        text = _ensure_native_block(text)
+        text, (content_start, block_end) = _ensure_native_block(text)
     except ValueError as error:
         sys.exit(f"Failed to patch {pkg_path}: {error}")
+    editor = DslEditor(text, content_start, block_end)
 
     # 1. cc-flags: set ASan compile flags for MoonBit-generated C (entry packages only)
     if is_entry and "cc-flags" in flags:
-        text = _replace_or_insert_in_native(text, "cc-flags", flags["cc-flags"])
+        editor.replace_or_insert("cc-flags", flags["cc-flags"])
 
     # 2. stub-cc-flags: append ASan flags (or override on Windows)
+    existing_stub_flags = editor.get("stub-cc-flags")
     if "stub-cc-flags" in flags:
-        text = _replace_or_insert_in_native(
-            text, "stub-cc-flags", flags["stub-cc-flags"]
+        editor.replace_or_insert("stub-cc-flags", flags["stub-cc-flags"])
+    elif existing_stub_flags is None:
+        editor.replace_or_insert("stub-cc-flags", ASAN_COMPILE_FLAGS)
+    elif ASAN_COMPILE_FLAGS not in existing_stub_flags:
+        # (Already present when left over from an interrupted run.)
+        editor.replace_or_insert(
+            "stub-cc-flags", f"{existing_stub_flags} {ASAN_COMPILE_FLAGS}"
         )
-    else:
-        existing = _find_string_value_in_native(text, "stub-cc-flags")
-        if existing is not None:
-            new_value = f"{existing} {ASAN_COMPILE_FLAGS}"
-            text = _replace_or_insert_in_native(text, "stub-cc-flags", new_value)
-        else:
-            text = _replace_or_insert_in_native(
-                text, "stub-cc-flags", ASAN_COMPILE_FLAGS
-            )
 
-    return text
+    return editor.finalize()
 
 
 # ---------------------------------------------------------------------------
@@ -532,26 +1091,115 @@ def is_dsl_format(pkg_path: Path) -> bool:
     return pkg_path.name == "moon.pkg"
 
 
-def _is_entry_package(pkg_path: Path) -> bool:
-    """Check if package is an entry package (is-main or has test files)."""
-    text = pkg_path.read_text(encoding="utf-8")
+def _is_entry_package(
+    pkg_path: Path, text: str, moon_pkg: dict[str, Any] | None = None
+) -> bool:
+    """Check if package is an entry package (is-main or has test files).
+
+    text is the package file content; moon_pkg is its parsed form for
+    moon.pkg.json files, if already available.
+    """
     # Check is-main in config
     if is_dsl_format(pkg_path):
-        if re.search(
-            r'(?:is-main|is_main|"is-main"|"is_main")\s*:\s*true\b',
-            text,
-        ):
+        if _IS_MAIN_DSL_RE.search(text):
             return True
     else:
-        data = json.loads(text)
-        if data.get("is-main") or data.get("is_main"):
+        if moon_pkg is None:
+            moon_pkg = load_json_pkg(text, pkg_path)
+        if moon_pkg.get("is-main") or moon_pkg.get("is_main"):
             return True
     # Heuristic: check for *_test.mbt files in the same directory.
     # Note: this won't detect test blocks inside non-_test.mbt files.
-    pkg_dir = pkg_path.parent
-    if list(pkg_dir.glob("*_test.mbt")):
-        return True
-    return False
+    try:
+        with os.scandir(pkg_path.parent) as entries:
+            return any(
+                entry.name.endswith("_test.mbt") and entry.is_file()
+                for entry in entries
+            )
+    except OSError:
+        return False
+
+
+@dataclass
+class PkgCtx:
+    """A package file and the facts about it that patching needs."""
+
+    path: Path
+    is_dsl: bool
+    is_entry: bool
+    original_text: str
+    # Parsed moon.pkg.json (None for DSL files); patching updates it in place.
+    moon_pkg: dict[str, Any] | None = None
+    # Link to the original file, set once patching is about to overwrite it.
+    backup: Path | None = None
+
+
+def _backup_path(pkg_path: Path) -> Path:
+    return pkg_path.with_name(pkg_path.name + ".asan-bak")
+
+
+def load_pkg_ctx(pkg_path: Path) -> PkgCtx:
+    """Snapshot a package file and classify it, reading it exactly once."""
+    backup = _backup_path(pkg_path)
+    if backup.exists():
+        sys.exit(
+            f"Found {backup} left by an interrupted run. Move it back to "
+            f"{pkg_path.name} (or delete it if the file is already restored)."
+        )
+    text = _read_text(pkg_path)
+    if is_dsl_format(pkg_path):
+        is_entry = _is_entry_package(pkg_path, text)
+        return PkgCtx(pkg_path, True, is_entry, text)
+    moon_pkg = load_json_pkg(text, pkg_path)
+    is_entry = _is_entry_package(pkg_path, text, moon_pkg)
+    return PkgCtx(pkg_path, False, is_entry, text, moon_pkg)
+
+
+def _patch_pkg_file(pkg: PkgCtx, flags: dict[str, str], force: bool) -> bool:
+    """Patch one package file in place from its snapshot text.
+
+    The file is left untouched if it already carries the ASan flags, unless
+    force is set. Returns whether the file was written.
+    """
+    text = pkg.original_text
+    if pkg.is_dsl:
+        patched = patch_dsl_file(text, pkg.path, flags, pkg.is_entry)
+    else:
+        patched = patch_json_file(text, pkg.path, flags, pkg.is_entry, pkg.moon_pkg)
+    if patched == text and not force:
+        return False
+    # atomic_write swaps in a new inode, so a hard link keeps the
+    # original bytes intact without copying them.
+    backup = _backup_path(pkg.path)
+    try:
+        os.link(pkg.path, backup)
+    except OSError:
+        shutil.copy2(pkg.path, backup)
+    pkg.backup = backup
+    if patched is None:
+        atomic_write(pkg.path, lambda fp: write_json_pkg(pkg.moon_pkg, fp))
+    else:
+        atomic_write_text(pkg.path, patched)
+    return True
+
+
+def _restore_pkg_file(pkg: PkgCtx) -> None:
+    if pkg.backup is not None:
+        os.replace(pkg.backup, pkg.path)
+
+
+def _map_concurrently(fn: Callable[..., T], *iterables: Iterable[Any]) -> list[T]:
+    """Like list(map(...)) but runs fn on a thread pool, preserving order.
+
+    Package files are independent, so their IO overlaps well. The pool is
+    drained before returning, even when fn raises.
+    """
+    with ThreadPoolExecutor(max_workers=MAX_IO_WORKERS) as pool:
+        return list(pool.map(fn, *iterables))
+
+
+def _exit_on_signal(signum: int, frame: Any) -> None:
+    sys.exit(128 + signum)
 
 
 def main():
@@ -577,6 +1225,19 @@ def main():
         action="store_true",
         help="Skip disabling mimalloc (not recommended).",
     )
+    parser.add_argument(
+        "--refresh-toolchain",
+        action="store_true",
+        help="Ignore cached compiler detection results and probe again.",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help=(
+            "Rewrite package files and libmoonbitrun.o even if they already "
+            "carry the ASan setup (forces a full rebuild)."
+        ),
+    )
     args = parser.parse_args()
 
     repo_root = args.repo_root.resolve()
@@ -591,7 +1252,9 @@ def main():
 
     pkg_paths: list[Path] = []
     seen_pkg_paths: set[Path] = set()
-    for pkg_arg in args.pkg:
+    # Drop repeated arguments before resolving; the set still catches
+    # different spellings of the same file.
+    for pkg_arg in dict.fromkeys(args.pkg):
         pkg_path = resolve_pkg_path(repo_root, pkg_arg)
         if pkg_path in seen_pkg_paths:
             continue
@@ -599,6 +1262,7 @@ def main():
         pkg_paths.append(pkg_path)
         resolved_name = pkg_path.name
         requested_name = Path(pkg_arg).name
+        # Printed as we go so the lines survive a later --pkg failing.
         if requested_name != resolved_name:
             print(
                 f"Resolved --pkg {pkg_arg} -> {display_path(pkg_path, repo_root)}"
@@ -609,29 +1273,22 @@ def main():
             "No --pkg arguments provided. Specify at least one moon.pkg or moon.pkg.json."
         )
 
-    cc_path, flags = get_flags()
+    cc_path, flags = get_flags(args.refresh_toolchain)
     detect_leaks = flags.pop("detect_leaks", "1")
-    print(f"Platform: {platform.system()}")
-    print(f"ASan compiler: {cc_path}")
-    print(f"ASan compile flags: {flags['cc-flags']}")
-    print(f"Leak detection: {'enabled' if detect_leaks == '1' else 'disabled'}")
+    sys.stdout.write(
+        f"Platform: {_SYSTEM}\n"
+        f"ASan compiler: {cc_path}\n"
+        f"ASan compile flags: {flags['cc-flags']}\n"
+        f"Leak detection: {'enabled' if detect_leaks == '1' else 'disabled'}\n"
+    )
 
     # Snapshot originals
-    snapshots: dict[Path, str] = {}
-    for pkg_path in pkg_paths:
-        snapshots[pkg_path] = pkg_path.read_text(encoding="utf-8")
-
-    # Disable mimalloc by replacing libmoonbitrun.o with an empty object.
-    # MoonBit bundles mimalloc which intercepts malloc/free and prevents
-    # ASan from tracking allocations properly.
-    mimalloc_backup: tuple[Path, bytes] | None = None
-    if not args.no_disable_mimalloc:
-        mimalloc_backup = disable_mimalloc(cc_path)
+    pkgs = _map_concurrently(load_pkg_ctx, pkg_paths)
 
     # Build environment
     env = os.environ.copy()
     # MOON_CC/MOON_AR only needed on macOS (Apple Clang lacks LSan)
-    if platform.system() == "Darwin":
+    if _SYSTEM == "Darwin":
         env["MOON_CC"] = cc_path
         env["MOON_AR"] = "/usr/bin/ar"
     asan_opts = f"detect_leaks={detect_leaks}:fast_unwind_on_malloc=0"
@@ -640,17 +1297,30 @@ def main():
     if lsan_suppressions.exists():
         env["LSAN_OPTIONS"] = f"suppressions={lsan_suppressions}"
 
+    # Turn SIGTERM (e.g. a CI timeout) into SystemExit so the finally block
+    # below still restores everything, as it does for Ctrl-C.
+    signal.signal(signal.SIGTERM, _exit_on_signal)
+    mimalloc_backup: tuple[Path, bytes] | None = None
     try:
-        for pkg_path in pkg_paths:
-            is_entry = _is_entry_package(pkg_path)
-            if is_dsl_format(pkg_path):
-                patched = patch_dsl_file(pkg_path, flags, is_entry)
-            else:
-                patched = patch_json_file(pkg_path, flags, is_entry)
-            pkg_path.write_text(patched, encoding="utf-8")
-            fmt = "DSL" if is_dsl_format(pkg_path) else "JSON"
-            kind = "entry" if is_entry else "library"
-            print(f"Patched ({fmt}, {kind}): {display_path(pkg_path, repo_root)}")
+        # Disable mimalloc by replacing libmoonbitrun.o with an empty object.
+        # MoonBit bundles mimalloc which intercepts malloc/free and prevents
+        # ASan from tracking allocations properly.
+        if not args.no_disable_mimalloc:
+            mimalloc_backup = disable_mimalloc(cc_path, args.force)
+
+        written = _map_concurrently(
+            _patch_pkg_file, pkgs, repeat(flags), repeat(args.force)
+        )
+        msgs: list[str] = []
+        for pkg, was_written in zip(pkgs, written):
+            fmt = "DSL" if pkg.is_dsl else "JSON"
+            kind = "entry" if pkg.is_entry else "library"
+            status = "Patched" if was_written else "Unchanged"
+            shown = display_path(pkg.path, repo_root)
+            msgs.append(f"{status} ({fmt}, {kind}): {shown}\n")
+        # One write per phase; flush so it precedes moon's own output.
+        sys.stdout.write("".join(msgs))
+        sys.stdout.flush()
 
         result = subprocess.run(
             ["moon", "test", "--target", "native", "-v"],
@@ -659,13 +1329,21 @@ def main():
         )
         sys.exit(result.returncode)
     finally:
-        for pkg_path, original in snapshots.items():
-            pkg_path.write_text(original, encoding="utf-8")
-            print(f"Restored: {display_path(pkg_path, repo_root)}")
+        # A second Ctrl-C or SIGTERM must not cut the restore short.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        # Only written files have a backup; leaving the others alone keeps
+        # their mtime and avoids a rebuild.
+        to_restore = [pkg for pkg in pkgs if pkg.backup is not None]
+        _map_concurrently(_restore_pkg_file, to_restore)
+        msgs = [
+            f"Restored: {display_path(pkg.path, repo_root)}\n" for pkg in to_restore
+        ]
         if mimalloc_backup is not None:
             moonbitrun_path, original_bytes = mimalloc_backup
             moonbitrun_path.write_bytes(original_bytes)
-            print(f"Restored mimalloc: {moonbitrun_path}")
+            msgs.append(f"Restored mimalloc: {moonbitrun_path}\n")
+        sys.stdout.write("".join(msgs))
 
 
 if __name__ == "__main__":